@@ -0,0 +1,23 @@
+import os
+
+# --- Gunicorn Configuration ---
+# Render provides the port as an env var.
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# gevent workers yield while waiting on Gemini, so one slow upstream call
+# doesn't block other requests. The gevent worker monkey-patches the standard
+# library itself before loading main:app, so the app must not be preloaded.
+# Set GUNICORN_WORKER_CLASS=gthread to use plain threads instead.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = 200
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Preloading would also start the prefetch scheduler in the master, whose
+# thread does not survive the fork into workers.
+preload_app = False
+
+# The gainers cache lives in process memory; every extra worker keeps its own
+# copy and refreshes it from Gemini separately.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Gemini calls can take up to 180s.
+timeout = 200
@@ -1,18 +1,44 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
+from apscheduler.schedulers.background import BackgroundScheduler
 import logging
-from datetime import datetime, timedelta
-import pytz
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from functools import wraps
+import hashlib
+import threading
+import time
 import os
-import traceback
+import random
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+from zoneinfo import ZoneInfo
 
 # --- Basic Setup ---
+class ORJSONProvider(DefaultJSONProvider):
+    """Serializes jsonify responses with orjson instead of the stdlib encoder."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
+# --- Compression ---
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 512
+Compress(app)
+EST = ZoneInfo('America/New_York')
+
 # --- API Key Setup ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
@@ -20,23 +46,77 @@ if not GEMINI_API_KEY:
 
 # --- Cache Setup ---
 api_cache = {
-    "data": None,
-    "last_updated": None
+    "body": None,
+    "etag": None,
+    "expires_at": 0.0,
+    "stale_until": 0.0
 }
-CACHE_DURATION = timedelta(minutes=15)
+# Each refresh picks a TTL in this range so expiries don't line up at fixed intervals.
+CACHE_MIN_SEC, CACHE_MAX_SEC = 12 * 60, 18 * 60
+# Past this age stale data is no longer served while refreshing; requests wait instead.
+CACHE_STALE_SEC = 60 * 60
+
+# --- Conditional Responses ---
+def compute_etag(body):
+    """Returns a short Blake2b digest of a response body for use as an ETag."""
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def conditional(max_age=60):
+    """Adds an ETag to the view's response and answers If-None-Match with a 304.
+
+    max_age may be a callable so the Cache-Control lifetime can follow the cache TTL.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            # Views may set the ETag themselves (e.g. from the cache) to skip rehashing.
+            etag = response.get_etag()[0]
+            if etag is None:
+                etag = compute_etag(response.get_data())
+                response.set_etag(etag)
+            # Flask-Compress sends the ETag with the encoding appended (e.g. "abc:br"),
+            # so clients echo it back that way; match it here to skip recompressing.
+            for tag in request.if_none_match.as_set():
+                if tag.split(':', 1)[0] == etag:
+                    response.set_etag(tag)
+                    break
+            seconds = max_age() if callable(max_age) else max_age
+            response.headers['Cache-Control'] = f'public, max-age={seconds}'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def cached_response(entry):
+    """Builds a response from a pre-encoded cache entry without re-serializing it."""
+    response = Response(entry["body"], mimetype='application/json')
+    response.set_etag(entry["etag"])
+    return response
 
 # --- Gemini API Configuration ---
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={GEMINI_API_KEY}"
 
-def get_gemini_analysis():
-    """Calls the Gemini API with search grounding to get stock analysis."""
-    if not GEMINI_API_KEY:
-        raise ValueError("Gemini API key is not configured.")
+# A shared session keeps the TLS connection to Gemini alive between refreshes.
+# Read timeouts are not retried: a single call can already take up to 180s.
+# 429s are not retried either, so each call counts once against Gemini's quota,
+# and the final error response is returned so its body still gets logged.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=2,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False,
+    ),
+))
 
-    est = pytz.timezone('US/Eastern')
-    current_date = datetime.now(est).strftime('%Y-%m-%d')
-    
-    system_prompt = """
+GEMINI_SYSTEM_PROMPT = """
     You are a financial data API. Your task is to provide a detailed, real-time analysis for the top 10 trending day-gainer stocks.
     - You MUST use Google Search to get the latest, most accurate data for the current trading day.
     - First, find the top 100 day gainers from the DOW, Nasdaq, and S&P 500.
@@ -44,88 +124,219 @@ def get_gemini_analysis():
     - Your entire response MUST be a single, valid JSON array of objects.
     - Do NOT include any introductory text, concluding text, markdown formatting like ```json, or any other characters outside of the main JSON array. The response must be parsable JSON and nothing else.
     """
-    
-    user_prompt = f"Provide the top 10 stock gainer analysis for today, {current_date}."
-    
-    payload = {
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
-        "contents": [{"parts": [{"text": user_prompt}]}],
-        "tools": [{"google_search": {}}],
-        "generationConfig": {
-            # This is the fix: We are removing the unsupported "response_mime_type"
-            # and relying on the system prompt to ensure the output is valid JSON.
-            "temperature": 0.5,
-            "max_output_tokens": 8192,
-        }
+
+GEMINI_HEADERS = {'Content-Type': 'application/json'}
+
+# Everything except the dated user prompt is encoded once at import. The closing
+# brace is stripped so each call can append its "contents" field.
+GEMINI_PAYLOAD_PREFIX = orjson.dumps({
+    "systemInstruction": {"parts": [{"text": GEMINI_SYSTEM_PROMPT}]},
+    "tools": [{"google_search": {}}],
+    "generationConfig": {
+        # This is the fix: We are removing the unsupported "response_mime_type"
+        # and relying on the system prompt to ensure the output is valid JSON.
+        "temperature": 0.5,
+        "max_output_tokens": 8192,
     }
-    
-    headers = {'Content-Type': 'application/json'}
+})[:-1]
+
+def build_gemini_payload(user_prompt):
+    """Appends the per-call user prompt to the pre-encoded static payload."""
+    return GEMINI_PAYLOAD_PREFIX + b',"contents":[{"parts":[{"text":' + orjson.dumps(user_prompt) + b'}]}]}'
+
+# --- Upstream Rate Limiting ---
+class GeminiRateLimited(Exception):
+    """Raised when the local token bucket has no Gemini calls left."""
+
+class TokenBucket:
+    """Thread-safe token bucket refilling `rate` tokens per second up to `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+# Caps Gemini calls per process, so repeated failures on a cold cache can't hammer the API.
+GEMINI_CALLS_PER_MINUTE = float(os.getenv("GEMINI_CALLS_PER_MINUTE", "2"))
+GEMINI_BUCKET = TokenBucket(rate=GEMINI_CALLS_PER_MINUTE / 60, capacity=max(1, GEMINI_CALLS_PER_MINUTE))
+
+def get_gemini_analysis():
+    """Calls the Gemini API with search grounding to get stock analysis."""
+    if not GEMINI_API_KEY:
+        raise ValueError("Gemini API key is not configured.")
+    if not GEMINI_BUCKET.take():
+        raise GeminiRateLimited("Gemini call budget exhausted; try again shortly.")
+
+    current_date = datetime.now(EST).strftime('%Y-%m-%d')
+    user_prompt = f"Provide the top 10 stock gainer analysis for today, {current_date}."
     
     try:
-        response = requests.post(GEMINI_API_URL, headers=headers, data=json.dumps(payload), timeout=180)
+        response = SESSION.post(GEMINI_API_URL, headers=GEMINI_HEADERS, data=build_gemini_payload(user_prompt), timeout=180)
         response.raise_for_status()
         
-        response_json = response.json()
+        response_json = orjson.loads(response.content)
         # The text part of the response should now be a well-formatted JSON string
         json_string = response_json['candidates'][0]['content']['parts'][0]['text']
         
-        return json.loads(json_string)
+        return orjson.loads(json_string)
 
     except requests.exceptions.HTTPError as http_err:
         logging.error(f"HTTP error occurred: {http_err}")
         logging.error(f"Error Response Body: {http_err.response.text}")
         raise
 
+# --- Background Refresh ---
+REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+REFRESH_WAIT_SEC = 180
+REFRESH_LOCK = threading.Lock()
+refresh_future = None
+
+def refresh_cache():
+    """Fetches a new analysis from Gemini and publishes it to the cache."""
+    global api_cache
+    analysis_data = get_gemini_analysis()
+    body = orjson.dumps(analysis_data)
+    
+    # Replace the whole dict so readers never see a body paired with another ETag.
+    now = time.monotonic()
+    api_cache = {
+        "body": body,
+        "etag": compute_etag(body),
+        "expires_at": now + random.uniform(CACHE_MIN_SEC, CACHE_MAX_SEC),
+        "stale_until": now + CACHE_STALE_SEC
+    }
+    
+    logging.info(f"Successfully processed and cached analysis for {len(analysis_data)} stocks.")
+    return api_cache
+
+def _log_refresh_failure(future):
+    error = future.exception()
+    if isinstance(error, GeminiRateLimited):
+        logging.warning("Skipping refresh: Gemini call budget exhausted.")
+    elif error is not None:
+        logging.error("A major error occurred while refreshing from Gemini API", exc_info=error)
+
+def start_refresh(observed):
+    """Returns the in-flight refresh, starting one only if none is running.
+
+    observed is the cache entry the caller found stale. If a refresh has replaced
+    it since, the newer entry is returned instead of calling Gemini again.
+    """
+    global refresh_future
+    with REFRESH_LOCK:
+        if api_cache is not observed:
+            published = Future()
+            published.set_result(api_cache)
+            return published
+        if refresh_future is None or refresh_future.done():
+            refresh_future = REFRESH_EXECUTOR.submit(refresh_cache)
+            refresh_future.add_done_callback(_log_refresh_failure)
+        return refresh_future
+
+# --- Cache Prefetch ---
+# Refresh this many seconds before expiry so users never see the cache go stale.
+PREFETCH_LEAD_SEC = 90
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+
+def prefetch_gainers():
+    """Starts a refresh when the cache is empty or about to expire."""
+    cache = api_cache
+    if time.monotonic() + PREFETCH_LEAD_SEC >= cache["expires_at"]:
+        start_refresh(cache)
+
+def start_prefetch_scheduler():
+    """Warms the cache now and keeps it warm independent of traffic."""
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(prefetch_gainers, 'interval', minutes=1, next_run_time=datetime.now())
+    scheduler.start()
+    return scheduler
+
+def gainers_max_age():
+    """Lets clients reuse the gainers for up to 60s, but never past the cache expiry."""
+    remaining = int(api_cache["expires_at"] - time.monotonic())
+    return max(0, min(60, remaining))
+
 @app.route('/api/top-gainers')
+@conditional(max_age=gainers_max_age)
 def get_top_gainers_data():
-    global api_cache
-    if api_cache["data"] and datetime.utcnow() - api_cache["last_updated"] < CACHE_DURATION:
+    # Read the cache once; refreshes replace the whole dict so body and ETag always match.
+    cache = api_cache
+    now = time.monotonic()
+    if cache["body"] is not None and now < cache["expires_at"]:
         logging.info("Returning data from cache.")
-        return jsonify(api_cache["data"])
+        return cached_response(cache)
 
-    logging.info("Cache is stale. Fetching new analysis from Gemini API.")
-    
     if not GEMINI_API_KEY:
         return jsonify({"error": "API key is not configured on the server."}), 500
-        
+
+    if cache["body"] is not None and now < cache["stale_until"]:
+        logging.info("Cache is stale. Serving it while Gemini refreshes in the background.")
+        start_refresh(cache)
+        return cached_response(cache)
+
+    # Concurrent requests on an empty or too-old cache all wait on the same refresh.
+    logging.info("Cache is empty or too old. Waiting on a Gemini refresh.")
     try:
-        analysis_data = get_gemini_analysis()
-        
-        api_cache["data"] = analysis_data
-        api_cache["last_updated"] = datetime.utcnow()
-        
-        logging.info(f"Successfully processed and cached analysis for {len(analysis_data)} stocks.")
-        return jsonify(analysis_data)
+        return cached_response(start_refresh(cache).result(timeout=REFRESH_WAIT_SEC))
 
     except Exception as e:
-        logging.error(f"A major error occurred while calling Gemini API: {e}")
-        logging.error(traceback.format_exc())
-        if api_cache["data"]:
-            return jsonify(api_cache["data"])
+        # The refresh callback has already logged the underlying failure.
+        if cache["body"] is not None:
+            return cached_response(cache)
+        if isinstance(e, GeminiRateLimited):
+            return jsonify({"error": "The AI model is busy. Please try again shortly."}), 503
         return jsonify({"error": "Could not fetch data from the AI model."}), 500
 
 
+# The status body only changes once per second, so it is encoded at most once per second.
+status_cache = {"second": None, "body": None}
+
 @app.route('/api/market-status')
 def get_market_status():
+    global status_cache
     try:
-        est = pytz.timezone('US/Eastern')
-        current_time = datetime.now(est)
-        current_time_str = current_time.strftime('%I:%M:%S %p EST')
-        if current_time.weekday() < 5:
-            if current_time.hour >= 16 or current_time.hour < 4:
-                status = "CLOSED (AFTER-HOURS TRADING MAY OCCUR)"
-            elif current_time.hour < 9 or (current_time.hour == 9 and current_time.minute < 30):
-                status = "PRE-MARKET"
-            else:
-                status = "REGULAR HOURS"
+        second = int(time.time())
+        cache = status_cache
+        if cache["second"] == second:
+            body = cache["body"]
         else:
-            status = "CLOSED"
+            current_time = datetime.fromtimestamp(second, EST)
+            current_time_str = current_time.strftime('%I:%M:%S %p EST')
+            if current_time.weekday() < 5:
+                if current_time.hour >= 16 or current_time.hour < 4:
+                    status = "CLOSED (AFTER-HOURS TRADING MAY OCCUR)"
+                elif current_time.hour < 9 or (current_time.hour == 9 and current_time.minute < 30):
+                    status = "PRE-MARKET"
+                else:
+                    status = "REGULAR HOURS"
+            else:
+                status = "CLOSED"
+            
+            body = orjson.dumps({"status": f"Market is currently {status}", "time": current_time_str})
+            status_cache = {"second": second, "body": body}
         
-        return jsonify({"status": f"Market is currently {status}", "time": current_time_str})
+        response = Response(body, mimetype='application/json')
+        # The body carries a ticking clock, so an ETag would almost never match.
+        response.headers['Cache-Control'] = 'public, max-age=1'
+        return response
     except Exception as e:
         logging.error(f"Could not fetch market status: {e}")
         return jsonify({"status": "Market status is currently unavailable", "time": ""}), 500
 
+# Under the dev server's reloader, only the child process that serves requests prefetches.
+if GEMINI_API_KEY and PREFETCH_ENABLED and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+    start_prefetch_scheduler()
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)